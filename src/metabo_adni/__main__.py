@@ -93,10 +93,12 @@ def main():
                         help='Replace metabolite concentration values\
                               with residuals from a regression on medication\
                               intake. Medication file needs to exist in the\
-                              current directory.')
+                              directory of the ADNI files.')
     args = parser.parse_args()
+    # Non-metabolite columns are dropped when merging anyway
     files = load.read_files(args.D,
-                            args.P)
+                            args.P,
+                            metabolites_only=args.merge)
     files = metabolites.remove_missing(files,
                                        args.P,
                                        args.mmc)
@@ -115,7 +117,7 @@ def main():
     files = participants.consolidate_replicates(files,
                                                 args.P)
     files = participants.remove_non_fasters(files,
-                                            args.F)
+                                            os.path.join(args.D, args.F))
     files = participants.remove_bad_qc_tags(files,
                                             args.P)
     files = transformations.imputation(files,
@@ -138,7 +140,8 @@ def main():
                                               args.P)
     if args.residualize_meds:
         files = transformations.residualize_metabolites(files,
-                                                        args.P)
+                                                        args.P,
+                                                        args.D)
     print('=== Saving cleaned files ===')
-    for key in files:
-        files[key].to_csv(key + '.csv')
+    load.write_files(files,
+                     args.D)
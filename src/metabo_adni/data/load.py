@@ -1,11 +1,49 @@
 import os
-import glob
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
 import numpy as np
 import pandas as pd
 
+# Characters in column names that are replaced with '.'
+_BAD_COL_NAME = re.compile(r'[-:() ]')
+# First and last metabolite columns of each cohort type
+_METABO_LIMITS = {'FIA': ('C0', 'SM.C26.1'),
+                  'UPLC': ('Ala', 'SDMA'),
+                  'NMR': ('TOTAL_C', 'S_HDL_TG_PCT'),
+                  'P180': ('C0', 'SDMA')}
+# Version of the processed dataframes stored in the feather caches. Increase
+# it whenever the parsing changes, so that older caches are not used
+_CACHE_VERSION = 3
+# QC tag columns of the nmr platform
+_NMR_QC_COLS = ('EDTA_PLASMA',
+                'CITRATE_PLASMA',
+                'LOW_ETHANOL',
+                'MEDIUM_ETHANOL',
+                'HIGH_ETHANOL',
+                'ISOPROPYL_ALCOHOL',
+                'N_METHYL_2_PYRROLIDONE',
+                'POLYSACCHARIDES',
+                'AMINOCAPROIC_ACID',
+                'LOW_GLUCOSE',
+                'HIGH_LACTATE',
+                'HIGH_PYRUVATE',
+                'LOW_GLUTAMINE_OR_HIGH_GLUTAMATE',
+                'GLUCONOLACTONE',
+                'LOW_PROTEIN',
+                'UNEXPECTED_AMINO_ACID_SIGNALS',
+                'UNIDENTIFIED_MACROMOLECULES',
+                'UNIDENTIFIED_SMALL_MOLECULE_A',
+                'UNIDENTIFIED_SMALL_MOLECULE_B',
+                'UNIDENTIFIED_SMALL_MOLECULE_C',
+                'BELOW_LIMIT_OF_QUANTIFICATION')
+
 
 def read_files(directory: str,
-               platform: str) -> dict[str, pd.DataFrame]:
+               platform: str,
+               metabolites_only: bool = False,
+               sort: bool = True) -> dict[str, pd.DataFrame]:
     '''
     Read the files in the given directory and return a list of
     files with the possible parameters to run.
@@ -16,22 +54,28 @@ def read_files(directory: str,
         Directory where the files are located.
     platform: str
         Metabolomics platform to process.
+    metabolites_only: bool
+        Only read the metabolite columns and the columns needed for QC
+        (plate bar codes in the p180 and QC tags in the nmr platform).
+    sort: bool
+        Sort the dataframes by RID. Replicates keep their order in the file.
+        Otherwise, the rows are in the file order, also when read from the
+        feather caches.
 
     Returns
     ----------
     platform_files: dict[str, pd.DataFrame]
-        Dictionary of dataframe names and dataframes.
+        Dictionary of dataframe names and dataframes. Only cohorts whose
+        file is found in the directory are included.
     '''
-    os.chdir(directory)
-    dir_files = glob.glob('*')
-    platform_files = []
-    index_cols = ['RID']
+    dir_files = {entry.name for entry in os.scandir(directory)
+                 if entry.is_file()}
+    platform_files = {}
     if platform == 'p180':
-        df = pd.DataFrame()
-        platform_files = {'ADNI1-UPLC': df,
-                          'ADNI1-FIA': df,
-                          'ADNI2GO-UPLC': df,
-                          'ADNI2GO-FIA': df}
+        cohorts = ['ADNI1-UPLC',
+                   'ADNI1-FIA',
+                   'ADNI2GO-UPLC',
+                   'ADNI2GO-FIA']
         file_names = ['ADMCDUKEP180UPLC_01_15_16.csv',
                       'ADMCDUKEP180FIA_01_15_16.csv',
                       'ADMCDUKEP180UPLCADNI2GO.csv',
@@ -39,30 +83,62 @@ def read_files(directory: str,
         na_values = ['< LOD',
                      'No Interception',
                      '>Highest CS']
+        qc_cols = ['Plate.Bar.Code']
     elif platform == 'nmr':
-        platform_files = {'NMR': ''}
+        cohorts = ['NMR']
         file_names = ['ADNINIGHTINGALE2.csv']
         na_values = ['TAG']
+        qc_cols = list(_get_nmr_qc_cols())
     else:
         raise Exception('The platform should be p180 or nmr')
-
-    for i, f in enumerate(file_names):
-        if f in dir_files:
-            key = list(platform_files.keys())[i]
-            dat = pd.DataFrame(pd.read_csv(f,
-                                           na_values=na_values)).\
-                set_index(index_cols)
-            dat = dat.sort_index()
-            if 'ADNI2GO' in f:
-                dat = _replace_bad_col_names(dat)
-            # Carnosine is misspelled in ADNI2GO UPLC
-            if f == 'ADMCDUKEP180UPLCADNI2GO.csv':
-                dat = dat.rename(columns={'canosine': 'Carnosine'})
-            platform_files[key] = dat
+    keep_cols = qc_cols if metabolites_only else None
+
+    # Only cohorts with an existing file are returned
+    present_files = {key: f for key, f in zip(cohorts, file_names)
+                     if f in dir_files}
+    if present_files:
+        # Files are independent, so they are parsed concurrently
+        with ThreadPoolExecutor(max_workers=len(present_files)) as executor:
+            futures = {key: executor.submit(_read_data_file,
+                                            directory,
+                                            f,
+                                            key,
+                                            na_values,
+                                            keep_cols,
+                                            sort)
+                       for key, f in present_files.items()}
+            for key in futures:
+                platform_files[key] = futures[key].result()
 
     return platform_files
 
 
+def write_files(dat_dict: dict[str, pd.DataFrame],
+                directory: str) -> None:
+    '''
+    Write each dataframe to a csv file named after its key, in the given
+    directory. Files are written concurrently.
+
+    Parameters
+    ----------
+    dat_dict: dict[str, pd.DataFrame]
+        Dictionary with dataframe name and dataframe to write.
+    directory: str
+        Directory where the files are written.
+
+    Returns
+    ----------
+    None
+    '''
+    def write(key: str) -> None:
+        dat_dict[key].to_csv(os.path.join(directory,
+                                          key + '.csv'))
+
+    with ThreadPoolExecutor() as executor:
+        # Consume the results so that errors are raised
+        list(executor.map(write, dat_dict))
+
+
 def read_fasting_file(filepath: str) -> pd.Series:
     '''
     Read fasting file
@@ -77,22 +153,17 @@ def read_fasting_file(filepath: str) -> pd.Series:
     fasting_dat: pd.Series
         Series with fasting information.
     '''
-    fasting_dat = pd.DataFrame(pd.read_csv(filepath,
-                                           index_col='RID',
-                                           na_values=-4))
+    dat = pd.read_csv(filepath,
+                      engine='pyarrow',
+                      usecols=['RID', 'VISCODE2', 'BIFAST'],
+                      dtype={'BIFAST': 'float32'},
+                      na_values=['-4']).set_index('RID')
     # Keep only information from baseline
-    fasting_dat = fasting_dat.loc[fasting_dat.loc[:, 'VISCODE2'] == 'bl', ]
-    fasting_dat = fasting_dat.loc[:, 'BIFAST']
+    baseline = dat['VISCODE2'].to_numpy() == 'bl'
+    fasting_dat = dat.loc[baseline, 'BIFAST']
     # If duplicates, keep the largest observed value
-    duplicated_ID = fasting_dat.index[
-        fasting_dat.index.duplicated()].unique()
-    for i in duplicated_ID:
-        val = fasting_dat.loc[i].max()
-        fasting_dat.drop(i,
-                         axis='index',
-                         inplace=True)
-        fasting_dat.loc[i] = val
-    fasting_dat = fasting_dat.sort_index()
+    fasting_dat = fasting_dat.groupby(level='RID',
+                                      sort=False).max()
     return fasting_dat
 
 
@@ -110,67 +181,306 @@ def read_lod_files(directory: str) -> dict[str, pd.DataFrame]:
     lod_files: dict[str, pd.DataFrame]
         Dictionary of LOD dataframe names and LOD dataframes.
     '''
-    os.chdir(directory)
-    lod_files = {'ADNI1-UPLC': '',
-                 'ADNI1-FIA': '',
-                 'ADNI2GO-UPLC': '',
-                 'ADNI2GO-FIA': ''}
+    lod_files = {}
+    cohorts = ['ADNI1-UPLC',
+               'ADNI1-FIA',
+               'ADNI2GO-UPLC',
+               'ADNI2GO-FIA']
     filenames = ['P180UPLCLODvalues_ADNI1.csv',
                  'P180FIALODvalues_ADNI1.csv',
                  'P180UPLCLODvalues_ADNI2GO.csv',
                  'P180FIALODvalues_ADNI2GO.csv']
-    for i, key in enumerate(lod_files):
-        dat = pd.DataFrame(pd.read_csv(filenames[i],
-                                       encoding='latin_1'))
-        # Metabolite names in lod don't match those in the data
-        # Replace '-', ':', '(', ')' and ' ' with '.'
-        dat = _replace_bad_col_names(dat)
-        if 'UPLC' in key:
-            # Change metabolite name from Met.So to Met.SO
-            dat.rename(columns={'Met.SO': 'Met.So'},
-                       inplace=True)
-        elif key == 'ADNI2GO-FIA':
-            # In lod value ADNI2GO-FIA, the bar code plate needs fixing
-            barcode = dat['Plate.Bar.Code']
-            barcode = barcode.str.split(' ',
-                                        expand=True)[2].\
-                str.replace(pat='/',
-                            repl='-')
-            dat['Plate.Bar.Code'] = barcode
-        lod_files[key] = dat
+    # Files are independent, so they are parsed concurrently
+    with ThreadPoolExecutor(max_workers=len(cohorts)) as executor:
+        futures = {key: executor.submit(_read_lod_file,
+                                        directory,
+                                        filename,
+                                        key)
+                   for key, filename in zip(cohorts, filenames)}
+        for key in futures:
+            lod_files[key] = futures[key].result()
     return lod_files
 
 
-def read_meds_file() -> pd.DataFrame:
+def read_meds_file(directory: str = os.curdir) -> pd.DataFrame:
     '''
     Reads the medication file.
 
+    Parameters
+    ----------
+    directory: str
+        Directory where the medication file is located.
+
     Returns
     ----------
     meds: pd.DataFrame
         Medication dataframe.
     '''
-    file = 'ADMCPATIENTDRUGCLASSES_20170512.csv'
+    file = os.path.join(directory,
+                        'ADMCPATIENTDRUGCLASSES_20170512.csv')
     file_exists = os.path.exists(file)
     if file_exists:
-        meds = pd.read_csv(file).\
-            set_index(['RID'])
-        # Keeping only baseline
-        baseline = meds.loc[:, 'VISCODE2'] == 'bl'
-        # Removing extra column and no longer needed columns
-        meds.drop(['NA', 'VISCODE2', 'Phase'],
+        # Skipping extra column and no longer needed columns
+        reader = pd.read_csv(file,
+                             usecols=lambda col: col not in ('NA', 'Phase'),
+                             index_col='RID',
+                             chunksize=100_000)
+        # Keeping only baseline, while the file is read
+        meds = pd.concat(chunk.loc[chunk['VISCODE2'] == 'bl', :]
+                         for chunk in reader)
+        meds.drop('VISCODE2',
                   axis='columns',
                   inplace=True)
-        meds = meds.loc[baseline, :]
-        # Replacing not NA values
-        meds[meds.notna()] = 1
-        # Replacing NA values
-        meds = meds.replace(np.nan, 0)
+        # Not NA values are medications taken (1), NA values are not (0)
+        meds = meds.notna().astype('int8')
     else:
         raise Exception('There is no medication file')
     return meds
 
 
+def _read_data_file(directory: str,
+                    filename: str,
+                    cohort: str,
+                    na_values: list[str],
+                    keep_cols: Union[list[str], None] = None,
+                    sort: bool = True) -> pd.DataFrame:
+    '''
+    Read a single data file, using its feather cache if it is up to date.
+    The cache is only written when the whole file is read, and always keeps
+    the row order of the file, so that it serves both sort modes.
+
+    Parameters
+    ----------
+    directory: str
+        Directory where the file is located.
+    filename: str
+        Name of the file.
+    cohort: str
+        The cohort of the file (e.g. 'ADNI1-FIA').
+    na_values: list[str]
+        Values to consider as missing.
+    keep_cols: Union[list[str], None]
+        If given, only read the metabolite columns and these columns.
+    sort: bool
+        Sort the dataframe by RID, keeping the file order of replicates.
+        Otherwise, the rows are in the file order.
+
+    Returns
+    ----------
+    dat: pd.DataFrame
+        Dataframe with RID as index and fixed column names.
+    '''
+    index_cols = ['RID']
+    path = os.path.join(directory, filename)
+    cache_path = os.path.join(directory,
+                              f'{cohort}.v{_CACHE_VERSION}.feather')
+    if _is_cache_fresh(cache_path, path):
+        dat = pd.read_feather(cache_path).\
+            set_index(index_cols)
+        if keep_cols is not None:
+            metabo_names = _get_metabo_col_names(dat, cohort)
+            keep = dat.columns.isin(list(metabo_names) + keep_cols)
+            dat = dat.loc[:, keep]
+    else:
+        # The header is read once to find the columns to parse
+        raw_names = pd.read_csv(path,
+                                nrows=0).columns
+        fixed_names = _fix_col_names(raw_names)
+        # Metabolite limits are defined on the replaced column names
+        metabo_names = _get_metabo_col_names(
+            pd.DataFrame(columns=fixed_names),
+            cohort)
+        if keep_cols is None:
+            usecols = None
+        else:
+            usecols = _get_usecols(raw_names,
+                                   fixed_names,
+                                   metabo_names,
+                                   keep_cols)
+        dat = pd.read_csv(path,
+                          engine='pyarrow',
+                          usecols=usecols,
+                          dtype=_get_metabo_dtypes(raw_names,
+                                                   fixed_names,
+                                                   metabo_names),
+                          na_values=na_values).\
+            set_index(index_cols)
+        if 'ADNI2GO' in filename:
+            dat = _replace_bad_col_names(dat)
+        # Carnosine is misspelled in ADNI2GO UPLC
+        if filename == 'ADMCDUKEP180UPLCADNI2GO.csv':
+            dat = dat.rename(columns={'canosine': 'Carnosine'})
+        if usecols is None:
+            _write_cache(dat.reset_index(), cache_path)
+    if sort and not dat.index.is_monotonic_increasing:
+        dat = dat.sort_index(kind='mergesort')
+    return dat
+
+
+def _read_lod_file(directory: str,
+                   filename: str,
+                   cohort: str) -> pd.DataFrame:
+    '''
+    Read a single LOD file of the p180 platform, using a cached
+    feather file if it is up to date.
+
+    Parameters
+    ----------
+    directory: str
+        Directory of the LOD files.
+    filename: str
+        Name of the LOD file.
+    cohort: str
+        Cohort name of the LOD file.
+
+    Returns
+    ----------
+    dat: pd.DataFrame
+        LOD dataframe.
+    '''
+    path = os.path.join(directory, filename)
+    # LOD files never change, so the processed dataframe is cached
+    cache_path = os.path.splitext(path)[0] + f'.v{_CACHE_VERSION}.feather'
+    if _is_cache_fresh(cache_path, path):
+        return pd.read_feather(cache_path)
+    dat = pd.read_csv(path,
+                      engine='pyarrow',
+                      encoding='latin_1')
+    # Metabolite names in lod don't match those in the data
+    # Replace '-', ':', '(', ')' and ' ' with '.'
+    dat = _replace_bad_col_names(dat)
+    if 'UPLC' in cohort:
+        # Change metabolite name from Met.So to Met.SO
+        dat.rename(columns={'Met.SO': 'Met.So'},
+                   inplace=True)
+    elif cohort == 'ADNI2GO-FIA':
+        # In lod value ADNI2GO-FIA, the bar code plate needs fixing
+        # The plate is the third field when splitting on single spaces
+        barcode = dat['Plate.Bar.Code'].astype('string[pyarrow]')
+        plate = barcode.str.split(' ',
+                                  expand=True)[2]
+        dat['Plate.Bar.Code'] = plate.str.replace(pat='/',
+                                                  repl='-',
+                                                  regex=False)
+    _write_cache(dat, cache_path)
+    return dat
+
+
+def _get_usecols(raw_names: pd.Index,
+                 fixed_names: pd.Index,
+                 metabo_names: pd.Index,
+                 keep_cols: list[str]) -> list[str]:
+    '''
+    Get the original names of the columns to read from a data file:
+    RID, the metabolite columns and the columns to keep.
+
+    Parameters
+    ----------
+    raw_names: pd.Index
+        Column names in the header of the file.
+    fixed_names: pd.Index
+        Column names with the bad characters replaced.
+    metabo_names: pd.Index
+        Replaced names of the metabolite columns.
+    keep_cols: list[str]
+        Replaced names of the non-metabolite columns to keep.
+
+    Returns
+    ----------
+    usecols: list[str]
+        List of original column names.
+    '''
+    keep = set(['RID'] + list(metabo_names) + keep_cols)
+    usecols = [raw for raw, fixed in zip(raw_names, fixed_names)
+               if fixed in keep]
+    return usecols
+
+
+def _get_metabo_dtypes(raw_names: pd.Index,
+                       fixed_names: pd.Index,
+                       metabo_names: pd.Index) -> dict[str, str]:
+    '''
+    Get the dtypes of the metabolite columns of a data file, so that they
+    are parsed directly as floats.
+
+    Parameters
+    ----------
+    raw_names: pd.Index
+        Column names in the header of the file.
+    fixed_names: pd.Index
+        Column names with the bad characters replaced.
+    metabo_names: pd.Index
+        Replaced names of the metabolite columns.
+
+    Returns
+    ----------
+    dtypes: dict[str, str]
+        Dictionary of original metabolite column names and dtypes.
+    '''
+    start = fixed_names.get_loc(metabo_names[0])
+    end = start + len(metabo_names)
+    dtypes = {col: 'float64' for col in raw_names[start:end]}
+    return dtypes
+
+
+def _is_cache_fresh(cache_path: str,
+                    source_path: str) -> bool:
+    '''
+    Check whether a feather cache exists and is newer than its source file.
+
+    Parameters
+    ----------
+    cache_path: str
+        Path of the feather cache.
+    source_path: str
+        Path of the file the cache was built from.
+
+    Returns
+    ----------
+    fresh: bool
+        True if the cache can be used instead of the source file.
+    '''
+    fresh = os.path.isfile(cache_path) and \
+        os.path.getmtime(cache_path) >= os.path.getmtime(source_path)
+    return fresh
+
+
+def _write_cache(dat: pd.DataFrame,
+                 cache_path: str) -> None:
+    '''
+    Write a feather cache of an already processed dataframe.
+    The cache is written to a temporary file that replaces the cache once
+    complete, so an interrupted write never leaves a truncated cache.
+    The cache is skipped if the directory is not writable.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Dataframe to cache, with a default index.
+    cache_path: str
+        Path of the feather cache.
+
+    Returns
+    ----------
+    None
+    '''
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                        dir=os.path.dirname(cache_path) or
+                                        os.curdir)
+        os.close(fd)
+    except OSError:
+        return
+    try:
+        dat.to_feather(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def _get_metabo_col_names(dat: pd.DataFrame,
                           cohort: str) -> list[str]:
     '''
@@ -189,21 +499,19 @@ def _get_metabo_col_names(dat: pd.DataFrame,
         List of metabolite names
     '''
     cols = dat.columns
-    if 'FIA' in cohort:
-        start = list(cols).index('C0')
-        end = list(cols).index('SM.C26.1') + 1
-    elif 'UPLC' in cohort:
-        start = list(cols).index('Ala')
-        end = list(cols).index('SDMA') + 1
-    elif 'NMR' in cohort:
-        start = list(cols).index('TOTAL_C')
-        end = list(cols).index('S_HDL_TG_PCT') + 1
-    elif 'P180' in cohort:
-        start = list(cols).index('C0')
-        end = list(cols).index('SDMA') + 1
-    else:
-        start = 0
-        end = 0
+    start = 0
+    end = 0
+    for name, (first, last) in _METABO_LIMITS.items():
+        if name in cohort:
+            # Raise ValueError, as the former list.index lookup did
+            try:
+                start = cols.get_loc(first)
+                end = cols.get_loc(last) + 1
+            except KeyError as err:
+                raise ValueError(f'The {cohort} cohort ({name} platform) ' +
+                                 f'is missing the metabolite column {err}') \
+                    from err
+            break
 
     col_names = cols[start:end]
     return col_names
@@ -227,44 +535,23 @@ def _get_data_indices(dat: pd.DataFrame,
         List of indices.
     '''
     if platform == 'p180':
-        indices = dat.index < 99999
+        indices = dat.index.to_numpy() < 99999
     elif platform == 'nmr':
-        indices = np.repeat(True, len(dat.index))
+        indices = np.ones(len(dat.index), dtype=bool)
     else:
-        indices = np.ndarray([])
+        indices = np.empty(0, dtype=bool)
     return indices
 
 
-def _get_nmr_qc_cols() -> list[str]:
+def _get_nmr_qc_cols() -> tuple[str, ...]:
     '''
     Get the QC column names for the nmr platforms
 
     Returns
     ----------
-    qc_tag_names: list[str]
-    '''
-    qc_tag_names = ['EDTA_PLASMA',
-                    'CITRATE_PLASMA',
-                    'LOW_ETHANOL',
-                    'MEDIUM_ETHANOL',
-                    'HIGH_ETHANOL',
-                    'ISOPROPYL_ALCOHOL',
-                    'N_METHYL_2_PYRROLIDONE',
-                    'POLYSACCHARIDES',
-                    'AMINOCAPROIC_ACID',
-                    'LOW_GLUCOSE',
-                    'HIGH_LACTATE',
-                    'HIGH_PYRUVATE',
-                    'LOW_GLUTAMINE_OR_HIGH_GLUTAMATE',
-                    'GLUCONOLACTONE',
-                    'LOW_PROTEIN',
-                    'UNEXPECTED_AMINO_ACID_SIGNALS',
-                    'UNIDENTIFIED_MACROMOLECULES',
-                    'UNIDENTIFIED_SMALL_MOLECULE_A',
-                    'UNIDENTIFIED_SMALL_MOLECULE_B',
-                    'UNIDENTIFIED_SMALL_MOLECULE_C',
-                    'BELOW_LIMIT_OF_QUANTIFICATION']
-    return qc_tag_names
+    qc_tag_names: tuple[str, ...]
+    '''
+    return _NMR_QC_COLS
 
 
 def _replace_bad_col_names(dat: pd.DataFrame) -> pd.DataFrame:
@@ -281,9 +568,22 @@ def _replace_bad_col_names(dat: pd.DataFrame) -> pd.DataFrame:
     dat: pd.DataFrame
         Dataframe with replaced column names.
     '''
-    old_columns = dat.columns
-    new_columns = old_columns.str.replace(pat='-|:|\(|\)| ',
-                                          repl='.',
-                                          regex=True)
-    dat.columns = new_columns
+    dat.columns = _fix_col_names(dat.columns)
     return(dat)
+
+
+def _fix_col_names(col_names: pd.Index) -> pd.Index:
+    '''
+    Replace the non-compatible characters in column names with '.'.
+
+    Parameters
+    ----------
+    col_names: pd.Index
+        Original column names.
+
+    Returns
+    ----------
+    fixed_names: pd.Index
+        Column names with the bad characters replaced.
+    '''
+    return pd.Index([_BAD_COL_NAME.sub('.', col) for col in col_names])
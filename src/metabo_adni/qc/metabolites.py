@@ -1,5 +1,5 @@
+import numpy as np
 import pandas as pd
-import pingouin as pg
 from metabo_adni.data import load
 
 
@@ -34,9 +34,10 @@ def remove_missing(dat_dict: dict[str, pd.DataFrame],
         dat = dat_dict[key].loc[indices, metabo_names]
         metabolite_table = _generate_missing_table(dat, cutoff)
         _print_removed(metabolite_table, key)
-        dat_dict[key].drop(metabolite_table.index,
-                           axis=1,
-                           inplace=True)
+        if len(metabolite_table) > 0:
+            dat_dict[key].drop(metabolite_table.index,
+                               axis=1,
+                               inplace=True)
     print('')
     return dat_dict
 
@@ -69,21 +70,20 @@ def remove_cv(dat_dict: dict[str, pd.DataFrame],
         for key in dat_dict:
             metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                       key)
-            dat = dat_dict[key].loc[dat_dict[key].index < 99999, metabo_names]
-            cv_interplate = []
-            duplicated_ID = dat.index[
-                dat.index.duplicated()].unique()
-            for id in duplicated_ID:
-                duplicated_dat = dat.loc[id, :]
-                cv = duplicated_dat.std() / duplicated_dat.mean()
-                cv_interplate.append(cv)
-            cv_interplate = pd.DataFrame(pd.DataFrame(cv_interplate).mean(),
-                                         columns=['CV'])
-            remove_met_table = cv_interplate[cv_interplate['CV'] > cutoff]
+            indices = load._get_data_indices(dat_dict[key], platform)
+            dat = dat_dict[key].loc[indices, metabo_names]
+            # CV of each duplicated ID, averaged across IDs
+            replicates = dat.iloc[np.flatnonzero(
+                dat.index.duplicated(keep=False))]
+            grouped = replicates.groupby(level=0,
+                                         sort=False)
+            cv = (grouped.std() / grouped.mean()).mean()
+            remove_met_table = pd.DataFrame({'CV': cv[cv > cutoff]})
             _print_removed(remove_met_table, key)
-            dat_dict[key].drop(remove_met_table.index,
-                               axis=1,
-                               inplace=True)
+            if len(remove_met_table) > 0:
+                dat_dict[key].drop(remove_met_table.index,
+                                   axis=1,
+                                   inplace=True)
         print('')
         return dat_dict
     else:
@@ -118,34 +118,17 @@ def remove_icc(dat_dict: dict[str, pd.DataFrame],
         for key in dat_dict:
             metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                       key)
-            dat = dat_dict[key].loc[dat_dict[key].index < 99999, metabo_names]
-            duplicated_ID = dat.index[
-                dat.index.duplicated()].unique()
-            duplicated_dat = dat.loc[duplicated_ID]
-            raters = []
-            for j in duplicated_ID:
-                n_duplicates = len(duplicated_dat.loc[j])
-                for k in range(n_duplicates):
-                    raters.append(k+1)
-            iccs = []
-            for met in duplicated_dat.columns:
-                icc_dat = pd.DataFrame()
-                icc_dat['raters'] = raters
-                icc_dat['value'] = list(duplicated_dat[met])
-                icc_dat['targets'] = list(duplicated_dat.index)
-                icc_results = pg.intraclass_corr(icc_dat,
-                                                 targets='targets',
-                                                 raters='raters',
-                                                 ratings='value',
-                                                 nan_policy='omit')
-                iccs.append(icc_results.iloc[2, 2])
-            icc_values = pd.DataFrame(index=duplicated_dat.columns)
-            icc_values['ICC'] = iccs
-            remove_met_table = icc_values[icc_values['ICC'] < cutoff]
+            indices = load._get_data_indices(dat_dict[key], platform)
+            dat = dat_dict[key].loc[indices, metabo_names]
+            duplicated_dat = dat.iloc[np.flatnonzero(
+                dat.index.duplicated(keep=False))]
+            icc = _compute_icc(duplicated_dat)
+            remove_met_table = pd.DataFrame({'ICC': icc[icc < cutoff]})
             _print_removed(remove_met_table, key)
-            dat_dict[key].drop(remove_met_table.index,
-                               axis=1,
-                               inplace=True)
+            if len(remove_met_table) > 0:
+                dat_dict[key].drop(remove_met_table.index,
+                                   axis=1,
+                                   inplace=True)
         print('')
         return dat_dict
     else:
@@ -179,27 +162,86 @@ def cross_plate_correction(dat_dict: dict[str, pd.DataFrame],
                                                       key)
             col_names = list(metabo_names) + ['Plate.Bar.Code']
             dat = dat_dict[key][col_names]
-            dat_pool = dat.loc[999999, ]
-            global_qc_average = dat_pool.loc[:, metabo_names].mean()
-            plates_ID = dat_pool['Plate.Bar.Code'].unique()
-            for j in range(len(plates_ID)):
-                plate_name = plates_ID[j]
-                # Estimate the correction
-                q = dat_pool.loc[
-                    dat_pool['Plate.Bar.Code'] == plate_name,
-                    metabo_names].mean()
-                correction = q / global_qc_average
-                # Apply the correction
-                correct_rows = (dat['Plate.Bar.Code'] == plate_name) &\
-                    (dat.index < 99999)
-                new_dat = dat.loc[correct_rows, metabo_names] / correction
-                dat_dict[key].loc[correct_rows, metabo_names] = new_dat
+            plates = dat['Plate.Bar.Code'].astype('category')
+            pool_rows = dat.index.to_numpy() == 999999
+            dat_pool = dat.loc[pool_rows, metabo_names]
+            global_qc_average = dat_pool.mean()
+            # Estimate the correction of every plate with pools
+            plate_qc_average = dat_pool.groupby(plates[pool_rows],
+                                                observed=True,
+                                                sort=False).mean()
+            correction = plate_qc_average / global_qc_average
+            # One row per plate (and a last one for missing plates), samples
+            # in plates without pools are kept with a correction of 1
+            plate_correction = np.ones((len(plates.cat.categories) + 1,
+                                        len(metabo_names)))
+            plate_correction[plates.cat.categories.get_indexer(
+                correction.index)] = correction.to_numpy()
+            # Apply the correction
+            correct_rows = load._get_data_indices(dat, platform)
+            sample_codes = plates.cat.codes.to_numpy()[correct_rows]
+            new_dat = dat.loc[correct_rows, metabo_names].to_numpy() /\
+                plate_correction[sample_codes]
+            # Positional assignment skips the label alignment of loc
+            dat_dict[key].iloc[np.flatnonzero(correct_rows),
+                               dat_dict[key].columns.get_indexer(
+                                   metabo_names)] = new_dat
         print('')
         return dat_dict
     else:
         raise Exception('The platform should be p180 only')
 
 
+def _compute_icc(dat: pd.DataFrame) -> pd.Series:
+    '''
+    Compute the ICC3 (two-way mixed effects, consistency, single rater) of
+    each metabolite, using the replicates of each participant as raters.
+    As in pingouin, raters without any value are ignored and participants
+    with a missing rating are removed.
+
+    Parameters
+    ----------
+    dat: pd.DataFrame
+        Dataframe with metabolites only, and replicated participants only.
+
+    Returns
+    ----------
+    icc: pd.Series
+        ICC value of each metabolite.
+    '''
+    targets, target_names = pd.factorize(dat.index)
+    raters = dat.groupby(level=0,
+                         sort=False).cumcount().to_numpy()
+    # Ratings in wide format (targets x raters x metabolites)
+    wide = np.full((len(target_names),
+                    raters.max(initial=-1) + 1,
+                    dat.shape[1]),
+                   np.nan)
+    wide[targets, raters] = dat.to_numpy(dtype=float)
+    observed = ~np.isnan(wide)
+    rater_mask = observed.any(axis=0)
+    target_mask = (observed | ~rater_mask).all(axis=1)
+    mask = target_mask[:, None, :] & rater_mask[None, :, :]
+    n = target_mask.sum(axis=0)
+    k = rater_mask.sum(axis=0)
+    ratings = np.where(mask, wide, 0)
+    # Two-way ANOVA mean squares, for all metabolites at once
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grand_mean = ratings.sum(axis=(0, 1)) / (n * k)
+        target_means = ratings.sum(axis=1) / k
+        rater_means = ratings.sum(axis=0) / n
+        ss_total = (mask * (ratings - grand_mean) ** 2).sum(axis=(0, 1))
+        ss_targets = k * (target_mask *
+                          (target_means - grand_mean) ** 2).sum(axis=0)
+        ss_raters = n * (rater_mask *
+                         (rater_means - grand_mean) ** 2).sum(axis=0)
+        ms_targets = ss_targets / (n - 1)
+        ms_error = (ss_total - ss_targets - ss_raters) / ((n - 1) * (k - 1))
+        icc = (ms_targets - ms_error) / (ms_targets + (k - 1) * ms_error)
+    return pd.Series(icc,
+                     index=dat.columns)
+
+
 def _generate_missing_table(dat: pd.DataFrame,
                             cutoff: float) -> pd.DataFrame:
     '''
@@ -219,12 +261,16 @@ def _generate_missing_table(dat: pd.DataFrame,
         Table with metabolite names and missing proportion
     '''
     total_rows = len(dat)
-    total_metabolites = pd.DataFrame(
-        dat.isna().sum(axis=0) / total_rows,
-        columns=['Missing percentage'])
-    less_than_cutoff = dat.isna().sum(axis=0) / total_rows \
-        > cutoff
-    metabolite_table = total_metabolites[less_than_cutoff]
+    values = dat.to_numpy(dtype=np.float64)
+    # The sum is only NaN if there are missing values
+    if np.isnan(values.sum()):
+        missing = np.isnan(values).sum(axis=0) / total_rows
+    else:
+        missing = np.zeros(values.shape[1])
+    less_than_cutoff = missing > cutoff
+    metabolite_table = pd.DataFrame(
+        {'Missing percentage': missing[less_than_cutoff]},
+        index=dat.columns[less_than_cutoff])
 
     return metabolite_table
 
@@ -1,6 +1,6 @@
-import warnings
 import numpy as np
 import pandas as pd
+import scipy.linalg as linalg
 import scipy.stats as stats
 from typing import Union
 from metabo_adni.data import load
@@ -37,10 +37,16 @@ def remove_missing(dat_dict: dict[str, pd.DataFrame],
         indices = load._get_data_indices(dat_dict[key], platform)
         dat = dat_dict[key].loc[indices, metabo_names]
         total_cols = dat.shape[1]
-        total_participants = pd.DataFrame(dat.isna().sum(axis=1) / total_cols,
-                                          columns=['Missing percentage'])
-        more_than_cutoff = dat.isna().sum(axis=1) / total_cols > cutoff
-        participant_table = total_participants[more_than_cutoff]
+        values = dat.to_numpy(dtype=np.float64)
+        # The sum is only NaN if there are missing values
+        if np.isnan(values.sum()):
+            missing = np.isnan(values).sum(axis=1) / total_cols
+        else:
+            missing = np.zeros(values.shape[0])
+        more_than_cutoff = missing > cutoff
+        participant_table = pd.DataFrame(
+            {'Missing percentage': missing[more_than_cutoff]},
+            index=dat.index[more_than_cutoff])
         _print_removed(participant_table, key)
         if len(participant_table) > 0:
             dat_dict[key].drop(participant_table.index,
@@ -70,28 +76,24 @@ def consolidate_replicates(dat_dict: dict[str, pd.DataFrame],
         consolidated.
     '''
     print('=== Consolidating replicates ===')
-    # Ignore performance warnings from multiindex pandas
-    warnings.simplefilter(action='ignore',
-                          category=pd.errors.PerformanceWarning)
     for key in dat_dict:
         metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                   key)
         indices = load._get_data_indices(dat_dict[key], platform)
         dat = dat_dict[key].loc[indices, metabo_names]
-        duplicated_ID = dat.index[
-            dat.index.duplicated()].unique()
-        print(f'There are {len(duplicated_ID)} duplicated IDs in {key} cohort.')
-        for j in duplicated_ID:
-            # Averaging metabolites, and keeping first row of the other cols
-            consolidated = dat.loc[j].mean()
-            other_cols = dat_dict[key].columns.difference(metabo_names)
-            first_row = dat_dict[key].loc[j, other_cols].iloc[0, ]
-            new_row = pd.concat([first_row, consolidated])
-            new_row = new_row[dat_dict[key].columns]
-            dat_dict[key].drop(j,
-                               axis='index',
-                               inplace=True)
-            dat_dict[key].loc[j] = new_row
+        duplicated = dat.index.duplicated(keep=False)
+        n_duplicated = dat.index[duplicated].nunique()
+        print(f'There are {n_duplicated} duplicated IDs in {key} cohort.')
+        # Averaging metabolites, and keeping first row of the other cols
+        replicate_rows = np.flatnonzero(indices)[duplicated]
+        grouped = dat_dict[key].iloc[replicate_rows].groupby(level=0,
+                                                             sort=False)
+        consolidated = grouped.head(1)
+        consolidated.loc[:, metabo_names] = grouped[metabo_names].mean()
+        keep_rows = np.ones(len(dat_dict[key]), dtype=bool)
+        keep_rows[replicate_rows] = False
+        dat_dict[key] = pd.concat([dat_dict[key].iloc[keep_rows],
+                                   consolidated])
         # The bl column is created in nmr (don't know why)
         if 'bl' in dat_dict[key].columns:
             dat_dict[key].drop('bl',
@@ -159,7 +161,7 @@ def remove_bad_qc_tags(dat_dict: dict[str, pd.DataFrame],
     print('=== Removing participants with bad QC tags ===')
     if platform == 'nmr':
         # Remove participants with at least one observed QC tag flagged.
-        qc_tag_names = load._get_nmr_qc_cols()
+        qc_tag_names = list(load._get_nmr_qc_cols())
         n_cols = len(qc_tag_names)
         id_list = dat_dict['NMR'].loc[:, qc_tag_names].iloc[:, :n_cols-1].\
             sum(axis=1) > 0
@@ -208,22 +210,28 @@ def remove_moutliers(dat_dict: dict[str, pd.DataFrame],
                                                   key)
         indices = load._get_data_indices(dat_dict[key], platform)
         dat = dat_dict[key].loc[indices, metabo_names]
-        cov_mat = dat.cov()
-        p2 = dat.mean()
-        cov_mat_pm1 = np.linalg.matrix_power(cov_mat, -1)
-        distances = []
-        for i, val in enumerate(dat.to_numpy()):
-            p1 = val
-            distance = (p1-p2).T.dot(cov_mat_pm1).dot(p1-p2)
-            distances.append(distance)
-        distances = np.array(distances)
+        cov_mat = dat.cov().to_numpy()
+        centered = dat.to_numpy() - dat.mean().to_numpy()
+        # Squared Mahalanobis distance of every participant at once.
+        # Participants with missing values get NaN distances, and are kept
+        try:
+            factor = linalg.cho_factor(cov_mat,
+                                       check_finite=False)
+            solved = linalg.cho_solve(factor,
+                                      centered.T,
+                                      check_finite=False).T
+        except linalg.LinAlgError:
+            # The covariance is not positive definite
+            solved = centered @ np.linalg.pinv(cov_mat)
+        distances = np.einsum('ij,ij->i', centered, solved)
         cutoff = stats.chi2.ppf(0.999, dat.shape[1]-1)
         i_to_remove = dat.loc[distances > cutoff].index
         print(f'{len(i_to_remove)} participants will be removed in the ' +
               f'{key} cohort')
-        dat_dict[key].drop(i_to_remove,
-                           axis='index',
-                           inplace=True)
+        if len(i_to_remove) > 0:
+            dat_dict[key].drop(i_to_remove,
+                               axis='index',
+                               inplace=True)
 
     print('')
     return dat_dict
@@ -1,7 +1,8 @@
+import os
 import numpy as np
 import pandas as pd
+import scipy.linalg as linalg
 import scipy.stats as stats
-import statsmodels.api as sm
 from typing import Union
 from metabo_adni.data import load
 
@@ -32,36 +33,52 @@ def imputation(dat_dict: dict[str, pd.DataFrame],
     print('=== Imputing metabolites ===')
     total_points_imputed = 0
     total_mets_imputed = []
+    use_lod = platform == 'p180' and lod_directory is not None
+    # LOD files are only read once a cohort has values to impute
+    lod_files = None
 
     for key in dat_dict:
         metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                   key)
         indices = load._get_data_indices(dat_dict[key], platform)
         dat = dat_dict[key].loc[indices, metabo_names]
-        mets_to_impute = dat.columns[dat.isna().any()]
-        data_points_impute = dat.isna().sum().sum()
+        values = dat.to_numpy(dtype=np.float64)
+        nan_mask = np.isnan(values)
+        impute_cols = np.flatnonzero(nan_mask.any(axis=0))
+        mets_to_impute = dat.columns[impute_cols]
+        data_points_impute = nan_mask.sum()
         total_mets_imputed.extend(mets_to_impute)
         total_points_imputed = total_points_imputed + data_points_impute
         print(f'{len(mets_to_impute)} metabolites and {data_points_impute} ' +
               f'data points will be imputed in the {key} cohort.')
-        for j in mets_to_impute:
-            indices = dat.loc[
-                dat[j].isna()].index
-            if platform == 'p180' and lod_directory is not None:
+        if use_lod and len(mets_to_impute) > 0:
+            if lod_files is None:
                 lod_files = load.read_lod_files(lod_directory)
-                dat = dat_dict[key].loc[dat_dict[key].index < 99999,
-                                        list(metabo_names) +
-                                        ['Plate.Bar.Code']]
-                barcode = pd.Series(dat.loc[indices, 'Plate.Bar.Code'])
-                vals = []
-                for bar in barcode:
-                    met_lod = lod_files[key].loc[:, 'Plate.Bar.Code'] == bar
-                    vals.append(lod_files[key].loc[
-                        met_lod, j])
-                dat_dict[key].loc[indices, j] = np.mean(vals) * 0.5
+            lod = lod_files[key].set_index('Plate.Bar.Code')
+            barcode = dat_dict[key].loc[indices, 'Plate.Bar.Code']
+            # Look up the LOD row of every sample plate once
+            if lod.index.is_unique:
+                plate_rows = lod.index.get_indexer(barcode)
             else:
-                half_min = dat.loc[:, j].min() / 2
-                dat_dict[key].loc[indices, j] = half_min
+                plate_rows = None
+            for i, j in zip(impute_cols, mets_to_impute):
+                missing = nan_mask[:, i]
+                # Half of the average LOD of the plates with missing values
+                if plate_rows is not None and \
+                        (plate_rows[missing] >= 0).all():
+                    plate_lod = lod[j].to_numpy()[plate_rows[missing]]
+                else:
+                    plate_lod = lod.loc[barcode[missing], j].to_numpy()
+                dat_dict[key].loc[dat.index[missing], j] = \
+                    np.mean(plate_lod) * 0.5
+        elif len(mets_to_impute) > 0:
+            impute_values = values[:, impute_cols]
+            # fmin skips NaN values, as the pandas min
+            half_min = np.fmin.reduce(impute_values, axis=0) / 2
+            dat_dict[key].loc[indices, mets_to_impute] = \
+                np.where(nan_mask[:, impute_cols],
+                         half_min,
+                         impute_values)
     print('')
     return dat_dict
 
@@ -135,9 +152,12 @@ def log2(dat_dict: dict[str, pd.DataFrame],
         metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                   key)
         indices = load._get_data_indices(dat_dict[key], platform)
-        dat = dat_dict[key].loc[indices, metabo_names]
-        log2_dat = np.log2(dat + 1)
-        dat_dict[key].loc[indices, metabo_names] = log2_dat
+        dat = dat_dict[key].loc[indices, metabo_names].to_numpy(
+            dtype=np.float64)
+        # In place, the selection is already a copy
+        dat += 1
+        np.log2(dat, out=dat)
+        dat_dict[key].loc[indices, metabo_names] = dat
     print('')
     return dat_dict
 
@@ -165,9 +185,10 @@ def zscore(dat_dict: dict[str, pd.DataFrame],
         metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                   key)
         indices = load._get_data_indices(dat_dict[key], platform)
-        dat = dat_dict[key].loc[indices, metabo_names]
-        zscore_dat = dat.apply(stats.zscore,
-                               nan_policy='omit')
+        dat = dat_dict[key].loc[indices, metabo_names].to_numpy(
+            dtype=np.float64)
+        zscore_dat = (dat - np.nanmean(dat, axis=0)) /\
+            np.nanstd(dat, axis=0)
         dat_dict[key].loc[indices, metabo_names] = zscore_dat
     print('')
     return dat_dict
@@ -196,24 +217,24 @@ def winsorize(dat_dict: dict[str, pd.DataFrame],
         metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                   key)
         indices = load._get_data_indices(dat_dict[key], platform)
-        dat = dat_dict[key].loc[indices, metabo_names]
-        three_std = np.std(dat) * 3
-        total_replacements = 0
-        for i, std in enumerate(three_std):
-            col = dat.columns[i]
-            high = dat.loc[:, col] > std
-            low = dat.loc[:, col] < -std
-            dat.loc[high, col] = std
-            dat.loc[low, col] = -std
-            total_replacements += sum(high) + sum(low)
+        dat = dat_dict[key].loc[indices, metabo_names].to_numpy(
+            dtype=np.float64)
+        three_std = np.nanstd(dat, axis=0) * 3
+        total_replacements = np.count_nonzero(np.abs(dat) > three_std)
+        np.clip(dat, -three_std, three_std, out=dat)
         print(f'Replaced {total_replacements} values in {key} cohort.')
-        dat_dict[key].loc[indices, metabo_names] = dat
+        # Positional assignment skips the label alignment of loc
+        dat_dict[key].iloc[np.flatnonzero(indices),
+                           dat_dict[key].columns.get_indexer(
+                               metabo_names)] = dat
     print('')
     return dat_dict
 
 
 def residualize_metabolites(dat_dict: dict[str, pd.DataFrame],
-                            platform: str) -> dict[str, pd.DataFrame]:
+                            platform: str,
+                            meds_directory: str = os.curdir) ->\
+        dict[str, pd.DataFrame]:
     '''
     Replace metabolite concentration values for the residuals on medication
     intake
@@ -224,10 +245,12 @@ def residualize_metabolites(dat_dict: dict[str, pd.DataFrame],
         Dictionary with dataframe name and dataframe to modify.
     platform: str
         Metabolomics platform to process.
+    meds_directory: str
+        Directory where the medication file is located.
     '''
     print('=== Replacing metabolite concentration values for residuals from ' +
           'medications ===')
-    meds = load.read_meds_file()
+    meds = load.read_meds_file(meds_directory)
     for key in dat_dict:
         metabo_names = load._get_metabo_col_names(dat_dict[key],
                                                   key)
@@ -261,28 +284,171 @@ def _get_residuals(outcomes,
     # Remove meds with only zeros
     keep_meds = X.mean() > 0
     X = X.loc[:, keep_meds]
-    for y in Y:
-        results = sm.OLS(exog=X,
-                         endog=Y[y]).fit()
-        med_names = list(X.columns)
-        n_significants = sum(results.pvalues < 0.05)
-        n_not_significants = sum(results.pvalues > 0.05)
+    x_values = X.to_numpy(dtype=np.float64)
+    y_values = Y.to_numpy(dtype=np.float64)
+    # Fit the full model for all metabolites at once, and only refit the
+    # metabolites with non significant medications
+    pinv_x, cov_diag, df_resid = _ols_design(x_values)
+    all_resid, all_pvalues = _ols_fit(pinv_x @ y_values,
+                                      cov_diag,
+                                      df_resid,
+                                      x_values,
+                                      y_values)
+    all_meds = tuple(range(x_values.shape[1]))
+    # With a full rank design every refit is solved from X^T X and X^T Y,
+    # otherwise (or if X^T X cannot be factorized) the statsmodels pinv
+    # decomposition is kept
+    full_rank = df_resid == x_values.shape[0] - x_values.shape[1]
+    if full_rank:
+        xtx = x_values.T @ x_values
+        xty = x_values.T @ y_values
+    designs = {}
+    for j, y in enumerate(Y):
+        resid = all_resid[:, j]
+        pvalues = all_pvalues[:, j]
+        med_names = list(all_meds)
+        n_significants = sum(pvalues < 0.05)
+        n_not_significants = sum(pvalues > 0.05)
         while n_not_significants > 0:
-            drop_med = results.pvalues[results.pvalues > 0.05].\
-                sort_values(ascending=False).\
-                index[0]
+            drop_med = med_names[np.argmax(np.where(pvalues > 0.05,
+                                                    pvalues,
+                                                    -np.inf))]
             med_names.remove(drop_med)
             if not med_names:
                 print(f'No significant medications in {y}')
                 break
             else:
-                results = sm.OLS(exog=X[med_names],
-                                 endog=Y[y]).fit()
-                n_significants = sum(results.pvalues < 0.05)
-                n_not_significants = sum(results.pvalues > 0.05)
+                # Designs are shared across metabolites dropping the same meds
+                meds_key = tuple(med_names)
+                if meds_key not in designs:
+                    if full_rank:
+                        designs[meds_key] = _xtx_design(
+                            x_values[:, med_names],
+                            xtx[np.ix_(med_names, med_names)])
+                    else:
+                        designs[meds_key] = (*_ols_design(
+                            x_values[:, med_names]), False)
+                coef_map, cov_diag, df_resid, on_xtx = designs[meds_key]
+                if on_xtx:
+                    params = coef_map @ xty[med_names, j:j+1]
+                else:
+                    params = coef_map @ y_values[:, [j]]
+                resid, pvalues = _ols_fit(params,
+                                          cov_diag,
+                                          df_resid,
+                                          x_values[:, med_names],
+                                          y_values[:, [j]])
+                resid = resid[:, 0]
+                pvalues = pvalues[:, 0]
+                n_significants = sum(pvalues < 0.05)
+                n_not_significants = sum(pvalues > 0.05)
         if n_significants > 0:
             print(f'There are significant medications in {y}')
-            print(med_names)
+            print(list(X.columns[med_names]))
             print('')
-            residuals[y] = results.resid
+            residuals[y] = resid
     return(residuals)
+
+
+def _ols_design(x: np.ndarray) -> tuple[np.ndarray, np.ndarray, int]:
+    '''
+    Decompose the design matrix of an OLS regression without intercept, the
+    same way as statsmodels OLS does with the pinv method.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        Design matrix with the predictor variables.
+
+    Returns
+    ----------
+    pinv_x: np.ndarray
+        Moore-Penrose pseudoinverse of the design matrix.
+    cov_diag: np.ndarray
+        Diagonal of the normalized covariance of the parameters.
+    df_resid: int
+        Residual degrees of freedom.
+    '''
+    u, singular_values, vt = np.linalg.svd(x, full_matrices=False)
+    cutoff = 1e-15 * np.max(singular_values)
+    inv_values = np.zeros_like(singular_values)
+    large = singular_values > cutoff
+    inv_values[large] = 1 / singular_values[large]
+    pinv_x = (vt.T * inv_values) @ u.T
+    cov_diag = np.einsum('ij,ij->i', pinv_x, pinv_x)
+    rank = np.linalg.matrix_rank(np.diag(singular_values))
+    df_resid = x.shape[0] - rank
+    return pinv_x, cov_diag, df_resid
+
+
+def _xtx_design(x: np.ndarray,
+                xtx: np.ndarray) -> tuple[np.ndarray, np.ndarray, int, bool]:
+    '''
+    Decompose the cross-product X^T X of a full rank design matrix of an OLS
+    regression without intercept. If the cross-product is too
+    ill-conditioned to be factorized, the design matrix is decomposed with
+    _ols_design instead.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        Design matrix with the predictor variables.
+    xtx: np.ndarray
+        Cross-product of the design matrix.
+
+    Returns
+    ----------
+    coef_map: np.ndarray
+        Inverse of the cross-product, mapping X^T y to the parameters, or
+        pseudoinverse of the design matrix, mapping y to the parameters.
+    cov_diag: np.ndarray
+        Diagonal of the normalized covariance of the parameters.
+    df_resid: int
+        Residual degrees of freedom.
+    on_xtx: bool
+        Whether coef_map is the inverse of the cross-product.
+    '''
+    n_params = xtx.shape[0]
+    try:
+        inv_xtx = linalg.cho_solve(linalg.cho_factor(xtx),
+                                   np.eye(n_params))
+    except linalg.LinAlgError:
+        return (*_ols_design(x), False)
+    return inv_xtx, np.diag(inv_xtx).copy(), x.shape[0] - n_params, True
+
+
+def _ols_fit(params: np.ndarray,
+             cov_diag: np.ndarray,
+             df_resid: int,
+             x: np.ndarray,
+             y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Get the residuals and p-values of an OLS regression of each column in y
+    on the same design matrix.
+
+    Parameters
+    ----------
+    params: np.ndarray
+        Estimated parameters (rows) for each outcome variable (columns).
+    cov_diag: np.ndarray
+        Diagonal of the normalized covariance of the parameters.
+    df_resid: int
+        Residual degrees of freedom.
+    x: np.ndarray
+        Design matrix with the predictor variables.
+    y: np.ndarray
+        Two dimensional array with one outcome variable per column.
+
+    Returns
+    ----------
+    resid: np.ndarray
+        Residuals for each outcome variable.
+    pvalues: np.ndarray
+        Two-tailed p-values for each parameter (rows) and outcome variable
+        (columns).
+    '''
+    resid = y - x @ params
+    scale = np.einsum('ij,ij->j', resid, resid) / df_resid
+    bse = np.sqrt(np.outer(cov_diag, scale))
+    pvalues = stats.t.sf(np.abs(params / bse), df_resid) * 2
+    return resid, pvalues